@@ -13,20 +13,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import queue as Queue
 import bz2
-import glob
+import collections
+import io
 import logging
 import os
-import select
+import selectors
+import shutil
+import subprocess
+import time
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from dogpile.cache import make_region
+from dogpile.cache.api import NoValue
 from rucio.common import config
 from rucio.common.dumper import LogPipeHandler
 from rucio.common.dumper import mkdir
 from rucio.common.dumper import temp_file
 from rucio.common.dumper.consistency import Consistency
+from rucio.common.exception import ConfigurationError, MissingModuleException
+from rucio.common.extra import import_extras
 from rucio.common.types import InternalAccount, InternalScope
 from rucio.common.utils import chunks
 from rucio.core.quarantined_replica import add_quarantined_replicas
@@ -36,18 +43,68 @@ from rucio.daemons.auditor.hdfs import ReplicaFromHDFS
 from rucio.daemons.auditor import srmdumps
 from rucio.db.sqla.constants import BadFilesStatus
 
+EXTRA_MODULES = import_extras(['zstandard'])
+
+if EXTRA_MODULES['zstandard']:
+    import zstandard  # pylint: disable=import-error
+
+
+# Parallel bzip2 implementation, ``pbzip2`` being preferred over
+# ``lbzip2``.  If neither is available the ``bz2`` module is used.
+PARALLEL_BZIP2 = shutil.which('pbzip2') or shutil.which('lbzip2')
+
+
+def _parallel_bzip2_command(threads):
+    """Return the command prefix to run ``PARALLEL_BZIP2``.
+
+    ``threads`` should be an ``int`` with the number of compression
+    threads to use.
+    """
+    if os.path.basename(PARALLEL_BZIP2) == 'pbzip2':
+        return [PARALLEL_BZIP2, '-f', '-9', '-p{0}'.format(threads)]
+    return [PARALLEL_BZIP2, '-f', '-9', '-n', str(threads)]
+
+
+# The RSE usage is only used for a rough sanity check, so it is cached
+# for a day.  This only helps when the results of the same RSE are
+# post-processed repeatedly within a day, e.g. when ``process_output()``
+# is invoked manually; the daemon itself checks each RSE at most once a
+# month and retries failed checks only after two weeks.
+REGION = make_region().configure('dogpile.cache.memory',
+                                 expiration_time=86400)
+
+
+def get_cached_rse_usage(rse_id):
+    """Return the Rucio usage of an RSE, cached for a day.
+
+    ``rse_id`` should be an ``str`` with the id of the RSE.
+
+    Returns a ``dict`` as the ones returned by ``get_rse_usage()``.
+    """
+    key = 'rse_usage_{0}'.format(rse_id)
+    usage = REGION.get(key)
+    if isinstance(usage, NoValue):
+        usage = get_rse_usage(rse_id=rse_id, source='rucio')[0]
+        REGION.set(key, usage)
+    return usage
+
 
 def consistency(rse, delta, configuration, cache_dir, results_dir):
     logger = logging.getLogger('auditor-worker')
     rsedump, rsedate = srmdumps.download_rse_dump(rse, configuration, destdir=cache_dir)
     results_path = os.path.join(results_dir, '{0}_{1}'.format(rse, rsedate.strftime('%Y%m%d')))  # pylint: disable=no-member
 
-    if os.path.exists(results_path + '.bz2') or os.path.exists(results_path):
+    if any(os.path.exists(results_path + extension) for extension in ('',) + COMPRESSED_EXTENSIONS):
         logger.warning('Consistency check for "%s" (dump dated %s) already done, skipping check', rse, rsedate.strftime('%Y%m%d'))  # pylint: disable=no-member
         return None
 
-    rrdump_prev = ReplicaFromHDFS.download(rse, rsedate - delta, cache_dir=cache_dir)
-    rrdump_next = ReplicaFromHDFS.download(rse, rsedate + delta, cache_dir=cache_dir)
+    # Both Rucio replica dumps depend only on the date of the RSE dump,
+    # so they are downloaded concurrently.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        rrdump_prev_future = executor.submit(ReplicaFromHDFS.download, rse, rsedate - delta, cache_dir=cache_dir)
+        rrdump_next_future = executor.submit(ReplicaFromHDFS.download, rse, rsedate + delta, cache_dir=cache_dir)
+        rrdump_prev = rrdump_prev_future.result()
+        rrdump_next = rrdump_next_future.result()
     results = Consistency.dump(
         'consistency-manual',
         rse,
@@ -59,8 +116,8 @@ def consistency(rse, delta, configuration, cache_dir, results_dir):
     )
     mkdir(results_dir)
     with temp_file(results_dir, results_path) as (output, _):
-        for result in results:
-            output.write('{0}\n'.format(result.csv()))
+        for chunk in chunks((result.csv() for result in results), 10000):
+            output.write('\n'.join(chunk) + '\n')
 
     return results_path
 
@@ -74,21 +131,28 @@ def guess_replica_info(path):
     Returns a ``tuple`` of which the first element is the scope of the
     replica and the second element is its name.
     """
-    items = path.split('/')
-    if len(items) == 1:
+    # Only the first two and the last components of the path matter, so
+    # the path is not split entirely.
+    head, sep, name = path.rpartition('/')
+    if not sep:
         return None, path
-    elif len(items) > 2 and items[0] in ['group', 'user']:
-        return '.'.join(items[0:2]), items[-1]
+    items = head.split('/', 2)
+    if len(items) > 1 and items[0] in ('group', 'user'):
+        return '.'.join(items[0:2]), name
     else:
-        return items[0], items[-1]
+        return items[0], name
 
 
-def bz2_compress_file(source, chunk_size=65000):
+def bz2_compress_file(source, chunk_size=1048576, threads=None):
     """Compress a file with bzip2.
 
     The destination is the path passed through ``source`` extended with
     '.bz2'.  The original file is deleted.
 
+    If ``pbzip2`` or ``lbzip2`` is installed, the compression is run in
+    a subprocess using several threads.  Otherwise the ``bz2`` module is
+    used.
+
     Errors are deliberately not handled gracefully.  Any exceptions
     should be propagated to the caller.
 
@@ -96,22 +160,157 @@ def bz2_compress_file(source, chunk_size=65000):
     to compress.
 
     ``chunk_size`` should be an ``int`` with the size (in bytes) of the
-    chunks by which to read the file.
+    chunks by which to read the file.  It is ignored when an external
+    compressor is used.
+
+    ``threads`` should be an ``int`` with the number of threads used by
+    the external compressor, by default one per core.  When several
+    files are compressed at once, it should be lowered accordingly so
+    that the cores are not oversubscribed.
 
     Returns an ``str`` with the destination path.
     """
     destination = '{}.bz2'.format(source)
-    with open(source) as plain, bz2.BZ2File(destination, 'w') as compressed:
-        while True:
-            chunk = plain.read(chunk_size)
-            if not chunk:
-                break
-            compressed.write(chunk.encode())
+    if PARALLEL_BZIP2:
+        subprocess.check_call(_parallel_bzip2_command(threads or os.cpu_count() or 1) + [source])
+        return destination
+    with open(source, 'rb') as plain, bz2.open(destination, 'wb', compresslevel=9) as compressed:
+        shutil.copyfileobj(plain, compressed, length=chunk_size)
     os.remove(source)
     return destination
 
 
-def process_output(output, sanity_check=True, compress=True):
+def zstd_compress_file(source, chunk_size=1048576, threads=None):
+    """Compress a file with Zstandard.
+
+    The destination is the path passed through ``source`` extended with
+    '.zst'.  The original file is deleted.
+
+    Errors are deliberately not handled gracefully.  Any exceptions
+    should be propagated to the caller.
+
+    ``source`` should be an ``str`` with the absolute path to the file
+    to compress.
+
+    ``chunk_size`` should be an ``int`` with the size (in bytes) of the
+    chunks by which to read the file.
+
+    ``threads`` should be an ``int`` with the number of compression
+    threads, by default one per core.
+
+    Returns an ``str`` with the destination path.
+    """
+    if not EXTRA_MODULES['zstandard']:
+        raise MissingModuleException('The zstandard module is not installed.')
+    destination = '{}.zst'.format(source)
+    compressor = zstandard.ZstdCompressor(level=9, threads=threads or -1)
+    with open(source, 'rb') as plain, open(destination, 'wb') as compressed:
+        compressor.copy_stream(plain, compressed, read_size=chunk_size)
+    os.remove(source)
+    return destination
+
+
+COMPRESSORS = {
+    'bz2': bz2_compress_file,
+    'zstd': zstd_compress_file,
+}
+
+# Extensions of the result files compressed by the compressors above.
+COMPRESSED_EXTENSIONS = ('.bz2', '.zst')
+
+
+def get_compressor():
+    """Return the compression function configured for the Auditor.
+
+    The algorithm is read from the 'compression' option of the
+    'auditor' section, either 'bz2' (default) or 'zstd'.
+
+    Raises ``ConfigurationError`` if the algorithm is unknown, and
+    ``MissingModuleException`` if its module is not installed.
+    """
+    compression = config.config_get('auditor', 'compression', False, 'bz2')
+    if compression not in COMPRESSORS:
+        raise ConfigurationError('Unknown auditor compression "{0}"'.format(compression))
+    if compression == 'zstd' and not EXTRA_MODULES['zstandard']:
+        raise MissingModuleException('The zstandard module is not installed.')
+    return COMPRESSORS[compression]
+
+
+def compress_file(source, threads=None):
+    """Compress a file with the algorithm configured for the Auditor.
+
+    The algorithm is chosen by ``get_compressor()``.
+
+    ``source`` should be an ``str`` with the absolute path to the file
+    to compress.  The original file is deleted.
+
+    ``threads`` should be an ``int`` with the number of compression
+    threads, by default one per core.
+
+    Returns an ``str`` with the destination path.
+    """
+    return get_compressor()(source, threads=threads)
+
+
+def open_output(output):
+    """Open a consistency check result file for reading, in binary mode.
+
+    ``output`` should be an ``str`` or a path-like object with the
+    absolute path to the file.  If it ends with '.bz2' or '.zst', it is
+    decompressed on the fly.
+
+    Returns a binary file object.
+    """
+    output = os.fspath(output)
+    if output.endswith('.bz2'):
+        return bz2.open(output, 'rb')
+    if output.endswith('.zst'):
+        if not EXTRA_MODULES['zstandard']:
+            raise MissingModuleException('The zstandard module is not installed.')
+        # The decompression reader cannot be iterated by lines by itself.
+        return io.BufferedReader(zstandard.open(output, 'rb'), buffer_size=1048576)
+    # The file is pure ASCII, so it is read as bytes with a large buffer.
+    return open(output, 'rb', buffering=1048576)
+
+
+def iter_output(output):
+    """Iterate over the entries of a consistency check result file.
+
+    ``output`` should be an ``str`` with the absolute path to the file
+    produced by ``consistency()``, possibly compressed.
+
+    Yields a ``tuple`` with the label ('DARK' or 'LOST'), path, scope
+    and name of each entry.  The file is read lazily so that the entries
+    never have to be held in memory all at once.  Lines with any other
+    label are skipped.
+    """
+    with open_output(output) as f:
+        for line in f:
+            # Both labels have the same length, so the path always starts
+            # at the same offset.
+            if line.startswith(b'DARK,'):
+                label = 'DARK'
+            elif line.startswith(b'LOST,'):
+                label = 'LOST'
+            else:
+                continue
+            path = line[5:].rstrip().decode()
+            scope, name = guess_replica_info(path)
+            yield label, path, scope, name
+
+
+class InternalScopeCache(dict):
+    """Map scope names to ``InternalScope`` objects, creating them once.
+
+    A result file holds millions of entries but only a handful of
+    distinct scopes, so sharing the objects spares most instantiations.
+    """
+    def __missing__(self, scope):
+        internal_scope = self[scope] = InternalScope(scope)
+        return internal_scope
+
+
+def process_output(output, sanity_check=True, compress=True, compression_threads=None):
     """Perform post-consistency-check actions.
 
     DARK files are put in the quarantined-replica table so that they
@@ -120,76 +319,144 @@ def process_output(output, sanity_check=True, compress=True):
 
     ``output`` should be an ``str`` with the absolute path to the file
     produced by ``consistency()``.  It must maintain its naming
-    convention.
+    convention.  If only its compressed version exists, the compressed
+    file is read instead.  This is only useful when invoking this
+    function manually, e.g. to process a result again: ``check()``
+    never gets there, as ``consistency()`` considers a result with a
+    compressed file as already done, and files are only compressed
+    once successfully processed.
 
     If ``sanity_check`` is ``True`` (default) and the number of entries
     in the output file is deemed excessive, the actions are aborted.
 
     If ``compress`` is ``True`` (default), the file is compressed with
-    bzip2 after the actions are successfully performed.
+    ``compress_file()`` after the actions are successfully performed,
+    unless it is already compressed or smaller than 1 KiB.  The
+    compression uses ``compression_threads`` threads, by default one per
+    core.
     """
+    process_outputs([output], sanity_check=sanity_check, compress=compress,
+                    compression_threads=compression_threads)
+
+
+def process_outputs(outputs, sanity_check=True, compress=True, compression_threads=None):
+    """Perform post-consistency-check actions on several files.
+
+    ``outputs`` should be a ``list`` of ``str`` or path-like objects
+    with the absolute paths to files produced by ``consistency()``.  They are grouped by RSE so
+    that the RSE and its usage are only looked up once per RSE; each is
+    then processed as described in ``process_output()``.
+
+    ``sanity_check``, ``compress`` and ``compression_threads`` have the
+    same meaning as in ``process_output()``.  A failed sanity check
+    aborts the processing of the remaining files.
+    """
+    threshold = config.config_get('auditor', 'threshold', False, 0.2)
+    chunk_size = config.config_get_int('auditor', 'chunk_size', False, 1000)
+
+    outputs_by_rse = collections.defaultdict(list)
+    for output in map(os.fspath, outputs):
+        outputs_by_rse[os.path.basename(output[:output.rfind('_')])].append(output)
+
+    for rse, rse_outputs in outputs_by_rse.items():
+        rse_id = get_rse_id(rse=rse)
+        usage = get_cached_rse_usage(rse_id)
+        for output in rse_outputs:
+            _process_output(output, rse_id, usage, threshold, chunk_size,
+                            sanity_check=sanity_check, compress=compress,
+                            compression_threads=compression_threads)
+
+
+def _process_output(output, rse_id, usage, threshold, chunk_size, sanity_check, compress, compression_threads):
+    """Process a single file for ``process_outputs()``."""
     logger = logging.getLogger('auditor-worker')
-    dark_replicas = []
-    lost_replicas = []
+    output = os.fspath(output)
+    if not os.path.exists(output):
+        for extension in COMPRESSED_EXTENSIONS:
+            if os.path.exists(output + extension):
+                output += extension
+                break
+    # The file is first only scanned to count the entries, so that the
+    # sanity check can be performed before any replica is materialized.
     try:
-        with open(output) as f:
-            for line in f:
-                label, path = line.rstrip().split(',', 1)
-                scope, name = guess_replica_info(path)
-                if label == 'DARK':
-                    dark_replicas.append({'path': path,
-                                          'scope': InternalScope(scope),
-                                          'name': name})
-                elif label == 'LOST':
-                    lost_replicas.append({'scope': InternalScope(scope),
-                                          'name': name})
-                else:
-                    raise ValueError('unexpected label')
+        with open_output(output) as f:
+            labels = collections.Counter(line.partition(b',')[0] for line in f)
+        if set(labels) - {b'DARK', b'LOST'}:
+            raise ValueError('unexpected label')
     # Since the file is read immediately after its creation, any error
     # exposes a bug in the Auditor.
     except Exception as error:
         logger.critical('Error processing "%s"', output, exc_info=True)
         raise error
 
-    rse = os.path.basename(output[:output.rfind('_')])
-    rse_id = get_rse_id(rse=rse)
-    usage = get_rse_usage(rse_id=rse_id, source='rucio')[0]
-    threshold = config.config_get('auditor', 'threshold', False, 0.2)
-
     # Perform a basic sanity check by comparing the number of entries
     # with the total number of files on the RSE.  If the percentage is
     # significant, there is most likely an issue with the site dump.
     found_error = False
-    if len(dark_replicas) > threshold * usage['files']:
+    if labels[b'DARK'] > threshold * usage['files']:
         logger.warning('Number of DARK files is exceeding threshold: "%s"',
                        output)
         found_error = True
-    if len(lost_replicas) > threshold * usage['files']:
+    if labels[b'LOST'] > threshold * usage['files']:
         logger.warning('Number of LOST files is exceeding threshold: "%s"',
                        output)
         found_error = True
     if found_error and sanity_check:
         raise AssertionError('sanity check failed')
 
-    # While converting LOST replicas to PFNs, entries that do not
-    # correspond to a replica registered in Rucio are silently dropped.
-    lost_pfns = [r['rses'][rse_id][0] for chunk in chunks(lost_replicas, 1000) for r in list_replicas(chunk) if rse_id in r['rses']]
-
-    for chunk in chunks(dark_replicas, 1000):
-        add_quarantined_replicas(rse_id=rse_id, replicas=chunk)
-    logger.debug('Processed %d DARK files from "%s"', len(dark_replicas),
+    def quarantine(dark_replicas):
+        add_quarantined_replicas(rse_id=rse_id, replicas=dark_replicas)
+
+    def declare_suspicious(lost_replicas):
+        # While converting LOST replicas to PFNs, entries that do not
+        # correspond to a replica registered in Rucio are silently dropped.
+        lost_pfns = [r['rses'][rse_id][0] for r in list_replicas(lost_replicas) if rse_id in r['rses']]
+        declare_bad_file_replicas(lost_pfns, reason='Reported by Auditor',
+                                  issuer=InternalAccount('root'), status=BadFilesStatus.SUSPICIOUS)
+
+    # The file is read a second and last time, dispatching the entries
+    # to a buffer per label.  Neither the DARK nor the LOST entries are
+    # ever held in memory all at once: each buffer is flushed as soon as
+    # it holds a chunk, which also bounds the size of the queries.
+    #
+    # DARK quarantines and LOST declarations are therefore interleaved.
+    # The order does not matter: DARK entries only end up in the
+    # quarantined-replica table, and only if no replica is registered
+    # for them, while LOST entries only end up in the bad-replica table,
+    # and only for the replicas list_replicas() finds registered.
+    actions = {'DARK': quarantine, 'LOST': declare_suspicious}
+    buffers = {'DARK': [], 'LOST': []}
+    scopes = InternalScopeCache()
+    try:
+        for label, path, scope, name in iter_output(output):
+            replica = {'scope': scopes[scope], 'name': name}
+            if label == 'DARK':
+                replica['path'] = path
+            buffers[label].append(replica)
+            if len(buffers[label]) >= chunk_size:
+                actions[label](buffers[label])
+                buffers[label] = []
+        for label, buffer in buffers.items():
+            if buffer:
+                actions[label](buffer)
+    # As above, but some chunks may already have been processed.
+    except Exception as error:
+        logger.critical('Error processing "%s"', output, exc_info=True)
+        raise error
+    logger.debug('Processed %d DARK files from "%s"', labels[b'DARK'],
                  output)
-    declare_bad_file_replicas(lost_pfns, reason='Reported by Auditor',
-                              issuer=InternalAccount('root'), status=BadFilesStatus.SUSPICIOUS)
-    logger.debug('Processed %d LOST files from "%s"', len(lost_replicas),
+    logger.debug('Processed %d LOST files from "%s"', labels[b'LOST'],
                  output)
 
-    if compress:
-        destination = bz2_compress_file(output)
+    # Small files, e.g. the empty results of healthy RSEs, are not worth
+    # compressing and are kept as they are.
+    if compress and not output.endswith(COMPRESSED_EXTENSIONS) and os.path.getsize(output) > 1024:
+        destination = compress_file(output, threads=compression_threads)
         logger.debug('Compressed "%s"', destination)
 
 
-def check(queue, retry, terminate, logpipe, cache_dir, results_dir, keep_dumps, delta_in_days):
+def check(queue, retry, terminate, logpipe, cache_dir, results_dir, keep_dumps, delta_in_days,
+          compression_threads=None):
     logger = logging.getLogger('auditor-worker')
     lib_logger = logging.getLogger('dumper')
 
@@ -208,35 +475,52 @@ def check(queue, retry, terminate, logpipe, cache_dir, results_dir, keep_dumps,
 
     delta = timedelta(days=delta_in_days)
 
+    # A wrong compression setting would otherwise only show up once the
+    # results of a check have been processed, failing the check.
+    try:
+        get_compressor()
+    except Exception:
+        logger.critical('Invalid auditor compression configuration', exc_info=True)
+        raise
+
     configuration = srmdumps.parse_configuration()
 
     while not terminate.is_set():
-        try:
-            rse, attemps = queue.get(timeout=30)
-        except Queue.Empty:
-            continue
-        start = datetime.now()
+        # A None sentinel is put on the queue for each worker at shutdown.
+        item = queue.get()
+        if item is None:
+            break
+        rse, attemps = item
+        start = time.monotonic()
         try:
             logger.debug('Checking "%s"', rse)
             output = consistency(rse, delta, configuration, cache_dir,
                                  results_dir)
             if output:
-                process_output(output)
-        except:
-            elapsed = (datetime.now() - start).total_seconds() / 60
+                process_output(output, compression_threads=compression_threads)
+        except Exception:
+            elapsed = (time.monotonic() - start) / 60
             logger.error('Check of "%s" failed in %d minutes, %d remaining attemps', rse, elapsed, attemps, exc_info=True)
             success = False
         else:
-            elapsed = (datetime.now() - start).total_seconds() / 60
+            elapsed = (time.monotonic() - start) / 60
             logger.info('SUCCESS checking "%s" in %d minutes', rse, elapsed)
             success = True
 
         if not keep_dumps:
-            remove = glob.glob(os.path.join(cache_dir, 'replicafromhdfs_{0}_*'.format(rse)))
-            remove.extend(glob.glob(os.path.join(cache_dir, 'ddmendpoint_{0}_*'.format(rse))))
-            logger.debug('Removing: %s', remove)
-            for fil in remove:
-                os.remove(fil)
+            prefixes = ('replicafromhdfs_{0}_'.format(rse), 'ddmendpoint_{0}_'.format(rse))
+            removed = 0
+            # The cache directory is only created once a dump has been
+            # found, so it may not exist yet if the check failed early.
+            try:
+                with os.scandir(cache_dir) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(prefixes):
+                            os.remove(entry.path)
+                            removed += 1
+            except FileNotFoundError:
+                pass
+            logger.debug('Removed %d cached dumps of "%s"', removed, rse)
 
         if not success and attemps > 0:
             retry.put((rse, attemps - 1))
@@ -253,8 +537,10 @@ def activity_logger(logpipes, logfilename, terminate):
     logger.addHandler(handler)
     logger.setLevel(logging.CRITICAL)  # The level of this logger is irrelevant
 
-    while not terminate.is_set():
-        ready, _, _ = select.select(logpipes, tuple(), tuple(), 30)
-        if ready:
-            for logpipe in ready:
-                logger.critical(logpipe.recv())
+    with selectors.DefaultSelector() as selector:
+        for logpipe in logpipes:
+            selector.register(logpipe, selectors.EVENT_READ)
+
+        while not terminate.is_set():
+            for key, _ in selector.select(timeout=30):
+                logger.critical(key.fileobj.recv())
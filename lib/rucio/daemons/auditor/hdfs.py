@@ -47,8 +47,7 @@ class ReplicaFromHDFS(Replica):
     def download(cls, rse, date, cache_dir=DUMPS_CACHE_DIR, buffer_size=65536):
         logger = logging.getLogger('auditor.hdfs')
 
-        if not os.path.isdir(cache_dir):
-            os.mkdir(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
         tmp_dir = tempfile.mkdtemp(dir=cache_dir)
 
         url = cls.BASE_URL.format(date.strftime('%Y-%m-%d'), rse)
@@ -66,7 +65,7 @@ class ReplicaFromHDFS(Replica):
             return path
 
         try:
-            logging.debug('Trying to download: %s for %s', url, rse)
+            logger.debug('Trying to download: %s for %s', url, rse)
 
             _hdfs_get(cls.BASE_URL.format(date.strftime('%Y-%m-%d'), rse), tmp_dir)
             files = (os.path.join(tmp_dir, file_) for file_ in sorted(os.listdir(tmp_dir)))
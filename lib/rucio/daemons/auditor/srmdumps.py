@@ -241,8 +241,7 @@ def download_rse_dump(rse, configuration, date='latest', destdir=DUMPS_CACHE_DIR
     else:
         url = '{0}/{1}'.format(base_url, date.strftime(url_pattern))
 
-    if not os.path.isdir(destdir):
-        os.mkdir(destdir)
+    os.makedirs(destdir, exist_ok=True)
 
     filename = '{0}_{1}_{2}_{3}'.format(
         'ddmendpoint',
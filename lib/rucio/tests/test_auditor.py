@@ -24,6 +24,8 @@ from datetime import timedelta
 
 import pytest
 
+from rucio.common.exception import ConfigurationError, MissingModuleException
+from rucio.common.types import InternalScope
 from rucio.daemons import auditor
 
 if sys.version_info >= (3, 3):
@@ -61,6 +63,208 @@ def test_auditor_bz2_compress_file(file_factory):
         assert f.read().decode() == test_data
 
 
+@pytest.mark.parametrize('executable,threads_args', [
+    ('/usr/bin/pbzip2', ['-p3']),
+    ('/usr/bin/lbzip2', ['-n', '3']),
+])
+@mock.patch('rucio.daemons.auditor.subprocess.check_call')
+def test_auditor_bz2_compress_file_with_parallel_bzip2(mock_check_call, executable, threads_args):
+    with mock.patch('rucio.daemons.auditor.PARALLEL_BZIP2', executable):
+        destination = auditor.bz2_compress_file('/tmp/source', threads=3)
+
+    assert destination == '/tmp/source.bz2'
+    mock_check_call.assert_called_once_with([executable, '-f', '-9'] + threads_args + ['/tmp/source'])
+
+
+@mock.patch('rucio.daemons.auditor.PARALLEL_BZIP2', None)
+def test_auditor_bz2_compress_file_without_parallel_bzip2(file_factory):
+    test_data = 'foo\n' * 1000
+    source = file_factory.file_generator(use_basedir=True, data=test_data)
+
+    destination = auditor.bz2_compress_file(source, chunk_size=16)
+
+    assert destination == str(source) + '.bz2'
+    assert not os.path.exists(source)
+    with bz2.BZ2File(destination) as f:
+        assert f.read().decode() == test_data
+
+
+@pytest.mark.skipif(not auditor.EXTRA_MODULES['zstandard'], reason='zstandard is not installed')
+def test_auditor_zstd_compress_file(file_factory):
+    test_data = 'foo'
+    source = file_factory.file_generator(use_basedir=True, data=test_data)
+
+    destination = auditor.zstd_compress_file(source)
+
+    assert destination == str(source) + '.zst'
+    assert not os.path.exists(source)
+    with open(destination, 'rb') as f:
+        assert auditor.zstandard.ZstdDecompressor().stream_reader(f).read().decode() == test_data
+
+
+@pytest.mark.parametrize('compression', ['bz2', 'zstd'])
+def test_auditor_compress_file_passes_threads(compression):
+    compressor = mock.Mock(return_value='/tmp/source.compressed')
+    with mock.patch.dict(auditor.COMPRESSORS, {compression: compressor}), \
+            mock.patch.dict(auditor.EXTRA_MODULES, {'zstandard': True}), \
+            mock.patch('rucio.daemons.auditor.config.config_get', return_value=compression):
+        assert auditor.compress_file('/tmp/source', threads=2) == '/tmp/source.compressed'
+
+    compressor.assert_called_once_with('/tmp/source', threads=2)
+
+
+@mock.patch('rucio.daemons.auditor.EXTRA_MODULES', {'zstandard': None})
+def test_auditor_get_compressor_validates_configuration():
+    with mock.patch('rucio.daemons.auditor.config.config_get', return_value='bz2'):
+        assert auditor.get_compressor() is auditor.bz2_compress_file
+    with mock.patch('rucio.daemons.auditor.config.config_get', return_value='zstd'), \
+            pytest.raises(MissingModuleException):
+        auditor.get_compressor()
+    with mock.patch('rucio.daemons.auditor.config.config_get', return_value='gzip'), \
+            pytest.raises(ConfigurationError):
+        auditor.get_compressor()
+
+
+def test_auditor_iter_output(file_factory):
+    test_data = 'DARK,user/foo/bar\nLOST,foo/baz\nDARK,qux\n'
+    output = file_factory.file_generator(use_basedir=True, data=test_data)
+
+    assert list(auditor.iter_output(output)) == [
+        ('DARK', 'user/foo/bar', 'user.foo', 'bar'),
+        ('LOST', 'foo/baz', 'foo', 'baz'),
+        ('DARK', 'qux', None, 'qux'),
+    ]
+
+
+def test_auditor_iter_output_compressed(file_factory):
+    test_data = 'DARK,user/foo/bar\nLOST,foo/baz\n'
+    output = auditor.bz2_compress_file(file_factory.file_generator(use_basedir=True, data=test_data))
+
+    assert list(auditor.iter_output(output)) == [
+        ('DARK', 'user/foo/bar', 'user.foo', 'bar'),
+        ('LOST', 'foo/baz', 'foo', 'baz'),
+    ]
+
+
+@pytest.mark.skipif(not auditor.EXTRA_MODULES['zstandard'], reason='zstandard is not installed')
+def test_auditor_iter_output_zstd_compressed(file_factory):
+    test_data = 'DARK,user/foo/bar\nLOST,foo/baz\n'
+    output = auditor.zstd_compress_file(file_factory.file_generator(use_basedir=True, data=test_data))
+
+    assert list(auditor.iter_output(output)) == [
+        ('DARK', 'user/foo/bar', 'user.foo', 'bar'),
+        ('LOST', 'foo/baz', 'foo', 'baz'),
+    ]
+
+
+def fake_list_replicas(dids):
+    return [{'rses': {'RSE_ID': ['pfn://' + did['name']]}} for did in dids]
+
+
+def fake_config_get(section, option, *args, **kwargs):
+    return {'threshold': 0.2, 'compression': 'bz2'}[option]
+
+
+def run_process_output(output, files, sanity_check=True, compress=False):
+    """Run ``process_output`` on ``output`` with the database calls mocked.
+
+    Returns the mocks of ``add_quarantined_replicas`` and
+    ``declare_bad_file_replicas``.
+    """
+    with mock.patch('rucio.daemons.auditor.get_rse_id', return_value='RSE_ID'), \
+            mock.patch('rucio.daemons.auditor.get_cached_rse_usage', return_value={'files': files}), \
+            mock.patch('rucio.daemons.auditor.config.config_get', side_effect=fake_config_get), \
+            mock.patch('rucio.daemons.auditor.config.config_get_int', return_value=2), \
+            mock.patch('rucio.daemons.auditor.list_replicas', side_effect=fake_list_replicas), \
+            mock.patch('rucio.daemons.auditor.add_quarantined_replicas') as mock_quarantine, \
+            mock.patch('rucio.daemons.auditor.declare_bad_file_replicas') as mock_declare:
+        auditor.process_output(output, sanity_check=sanity_check, compress=compress)
+    return mock_quarantine, mock_declare
+
+
+def test_auditor_process_output_in_chunks(tmp_path):
+    output = tmp_path / 'MOCK_RSE_20150101'
+    output.write_text('DARK,foo/a\nDARK,foo/b\nLOST,foo/c\nDARK,user/bar/d\nLOST,foo/e\nLOST,foo/f\n')
+
+    mock_quarantine, mock_declare = run_process_output(output, files=100)
+
+    assert [call.kwargs['replicas'] for call in mock_quarantine.call_args_list] == [
+        [{'path': 'foo/a', 'scope': InternalScope('foo'), 'name': 'a'},
+         {'path': 'foo/b', 'scope': InternalScope('foo'), 'name': 'b'}],
+        [{'path': 'user/bar/d', 'scope': InternalScope('user.bar'), 'name': 'd'}],
+    ]
+    assert all(call.kwargs['rse_id'] == 'RSE_ID' for call in mock_quarantine.call_args_list)
+    assert [call.args[0] for call in mock_declare.call_args_list] == [
+        ['pfn://c', 'pfn://e'],
+        ['pfn://f'],
+    ]
+
+
+@pytest.mark.parametrize('entries,compressed', [(10, False), (100, True)])
+@mock.patch('rucio.daemons.auditor.PARALLEL_BZIP2', None)
+def test_auditor_process_output_compresses_only_large_files(tmp_path, entries, compressed):
+    output = tmp_path / 'MOCK_RSE_20150101'
+    output.write_text(''.join('DARK,foo/{0:010d}\n'.format(i) for i in range(entries)))
+    assert (output.stat().st_size > 1024) == compressed
+
+    run_process_output(str(output), files=1000, compress=True)
+
+    assert output.exists() != compressed
+    assert os.path.exists(str(output) + '.bz2') == compressed
+
+
+def test_auditor_process_output_logs_errors_of_the_second_pass(tmp_path):
+    output = tmp_path / 'MOCK_RSE_20150101'
+    output.write_bytes(b'DARK,foo/a\nDARK,foo/\xff\n')
+
+    with mock.patch('rucio.daemons.auditor.logging.Logger.critical') as mock_critical, \
+            pytest.raises(UnicodeDecodeError):
+        run_process_output(output, files=100)
+
+    mock_critical.assert_called_once()
+
+
+@mock.patch('rucio.daemons.auditor.add_quarantined_replicas')
+def test_auditor_process_output_over_threshold_quarantines_nothing(mock_quarantine, tmp_path):
+    output = tmp_path / 'MOCK_RSE_20150101'
+    output.write_text('DARK,foo/a\nDARK,foo/b\nLOST,foo/c\n')
+
+    with mock.patch('rucio.daemons.auditor.get_rse_id', return_value='RSE_ID'), \
+            mock.patch('rucio.daemons.auditor.get_cached_rse_usage', return_value={'files': 5}), \
+            mock.patch('rucio.daemons.auditor.config.config_get', return_value=0.2), \
+            mock.patch('rucio.daemons.auditor.config.config_get_int', return_value=2), \
+            pytest.raises(AssertionError):
+        auditor.process_output(str(output), compress=False)
+
+    mock_quarantine.assert_not_called()
+
+
+@mock.patch('rucio.daemons.auditor.get_rse_usage', side_effect=lambda rse_id, source: [{'files': 1}])
+def test_auditor_get_cached_rse_usage(mock_get_rse_usage):
+    auditor.REGION.invalidate()
+
+    assert auditor.get_cached_rse_usage('RSE_ID') == {'files': 1}
+    assert auditor.get_cached_rse_usage('RSE_ID') == {'files': 1}
+    mock_get_rse_usage.assert_called_once_with(rse_id='RSE_ID', source='rucio')
+
+
+@mock.patch('rucio.daemons.auditor._process_output')
+@mock.patch('rucio.daemons.auditor.get_cached_rse_usage', side_effect=lambda rse_id: {'files': 1})
+@mock.patch('rucio.daemons.auditor.get_rse_id', side_effect=lambda rse: rse + '_ID')
+def test_auditor_process_outputs_looks_up_each_rse_once(mock_get_rse_id, mock_get_usage, mock_process_output):
+    outputs = ['/results/RSE_A_20150101', '/results/RSE_B_20150101', '/results/RSE_A_20150201']
+
+    auditor.process_outputs(outputs)
+
+    assert sorted(call.kwargs['rse'] for call in mock_get_rse_id.call_args_list) == ['RSE_A', 'RSE_B']
+    assert mock_get_usage.call_count == 2
+    assert [(call.args[0], call.args[1]) for call in mock_process_output.call_args_list] == [
+        ('/results/RSE_A_20150101', 'RSE_A_ID'),
+        ('/results/RSE_A_20150201', 'RSE_A_ID'),
+        ('/results/RSE_B_20150101', 'RSE_B_ID'),
+    ]
+
+
 def mock_fn_wrapper(return_value):
     calls = []
 
@@ -88,8 +292,11 @@ def test_auditor_download_dumps_with_expected_dates(mocked_srmdumps, mocked_hdfs
 
     auditor.consistency('RSENAME', timedelta(days=3), None, cache_dir=tmp_dir, results_dir=tmp_dir)
 
-    assert fake_rrd_download_calls[0]['args'][1] == date.strptime('29-12-2014', '%d-%m-%Y')
-    assert fake_rrd_download_calls[1]['args'][1] == date.strptime('04-01-2015', '%d-%m-%Y')
+    # The replica dumps are downloaded concurrently, so the calls may come in any order
+    assert sorted(call['args'][1] for call in fake_rrd_download_calls) == [
+        date.strptime('29-12-2014', '%d-%m-%Y'),
+        date.strptime('04-01-2015', '%d-%m-%Y'),
+    ]
 
 
 def mocked_auditor_consistency(rse, delta, configuration, cache_dir, results_dir):
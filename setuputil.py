@@ -93,6 +93,7 @@ server_requirements_table = {
         'globus-sdk',
     ],
     'saml': ['python3-saml'],
+    'zstd': ['zstandard'],
     'dev': dev_requirements
 }
 